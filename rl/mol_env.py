@@ -2,10 +2,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
 import collections
-import copy
-import itertools
+import dataclasses
+import functools
+import multiprocessing
+from concurrent import futures
 
+import numpy as np
 from rdkit import Chem
 from rdkit.Chem import Draw
 from six.moves import range
@@ -13,9 +17,44 @@ from six.moves import zip
 
 from rl import mol_utils
 
+# Order of the non-aromatic bond types; aromatic bonds are absent on purpose
+_BOND_ORDER_INDEX = {
+    Chem.BondType.SINGLE: 1,
+    Chem.BondType.DOUBLE: 2,
+    Chem.BondType.TRIPLE: 3
+}
+
+# Sanitization steps for candidate actions. Conjugation, hybridization and
+# chirality cleanup do not change the non-isomeric SMILES that is kept
+_SANITIZE_OPS = (Chem.SanitizeFlags.SANITIZE_ALL ^
+                 Chem.SanitizeFlags.SANITIZE_SETCONJUGATION ^
+                 Chem.SanitizeFlags.SANITIZE_SETHYBRIDIZATION ^
+                 Chem.SanitizeFlags.SANITIZE_CLEANUPCHIRALITY)
+
+# Least recently used cache of get_valid_actions results. Each entry holds a
+# full action set, so the size is kept small; reassign to trade memory for hits
+_VALID_ACTIONS_CACHE_SIZE = 10000
+_valid_actions_cache = collections.OrderedDict()
+
+# Process pools for _materialize_edits keyed by worker count. Workers are not
+# forked, since callers run inside TF/torch processes with live threads
+_executors = {}
+_MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+
+@functools.lru_cache(maxsize=10000)
+def _smiles_to_mol(smiles):
+    """Parse a SMILES with Chem.MolFromSmiles, memoized for revisited states
+
+    The returned Mol is shared between callers and must not be modified.
+    """
+    return Chem.MolFromSmiles(smiles)
+
 
-class Result(collections.namedtuple('Result', ['state', 'reward', 'terminated'])):
-    """A named tuple define teh result for a step for the molecular class
+@dataclasses.dataclass(frozen=True)
+class Result(object):
+    """Define the result of a step for the molecular class
 
     Argument
     ----------
@@ -31,13 +70,23 @@ class Result(collections.namedtuple('Result', ['state', 'reward', 'terminated'])
 
     """
 
+    __slots__ = ('state', 'reward', 'terminated')
+
+    state: str
+    reward: float
+    terminated: bool
+
 
 def get_valid_actions(state,
                       atom_types,
                       allow_removal,
                       allow_no_modification,
                       allowed_ring_sizes,
-                      allow_bonds_between_rings):
+                      allow_bonds_between_rings,
+                      atom_valences=None,
+                      max_valence=None,
+                      num_workers=None,
+                      mol=None):
     """Compute a set of valid action for given state
 
     Argument
@@ -58,141 +107,279 @@ def get_valid_actions(state,
 
         - allow_bonds_between_rings. Boolean.
 
+        - atom_valences. Dict or None.
+            Maps each atom type to its maximum valence. Computed from atom_types
+            if None.
+
+        - max_valence. Integer or None.
+            The largest value in atom_valences. Computed if None.
+
+        - num_workers. Integer or None.
+            Number of worker processes used to sanitize candidate molecules.
+            If None, candidates are sanitized in the calling process.
+
+        - mol. Chem.Mol or None.
+            The parsed state, if the caller already has it. It is only used to
+            build the canonical SMILES cache key. On a cache miss the actions are
+            enumerated from that canonical SMILES, parsed through the memoized
+            _smiles_to_mol, so a state given in canonical form (as every action
+            is) is not parsed twice. A non-canonical SMILES or a Chem.Mol costs
+            one extra parse on a miss.
+
+    Return
+
+        A frozenset of SMILES. Results are memoized on the canonical SMILES of
+        the state, so revisiting a state does not redo the enumeration.
+
     """
     # Check validity
     if not state:
-        return copy.deepcopy(atom_types)
+        return frozenset(atom_types)
 
-    mol = Chem.MolFromSmiles(state)
     if mol is None:
-        raise ValueError('Received invalid state: %s' % state)
+        mol = _smiles_to_mol(state)
+        if mol is None:
+            raise ValueError('Received invalid state: %s' % state)
+
+    if atom_valences is None:
+        atom_types = list(atom_types)
+        atom_valences = dict(list(zip(atom_types, mol_utils.atom_valences(atom_types))))
+    if max_valence is None:
+        max_valence = max(atom_valences.values())
+
+    # num_workers does not change the result, so it is not part of the key
+    key = (
+        Chem.MolToSmiles(mol),
+        tuple(sorted(atom_valences.items())),
+        max_valence,
+        allow_removal,
+        allow_no_modification,
+        None if allowed_ring_sizes is None else tuple(sorted(allowed_ring_sizes)),
+        allow_bonds_between_rings
+    )
 
-    # Get additional atoms valences
-    atom_valences = {
-        atom_type: mol_utils.atom_valences([atom_type])[0]
-        for atom_type in atom_types
-    }
+    valid_actions = _valid_actions_cache.get(key)
+    if valid_actions is not None:
+        _valid_actions_cache.move_to_end(key)
+        return valid_actions
 
-    # Get available atom location
-    atoms_with_free_valence = {}
-    for i in range(1, max(atom_valences.values())):
-        atoms_with_free_valence[i] = [
-            atom.GetIdx() for atom in mol.GetAtoms() if atom.GetNumImplicitHs() >= i
-        ]
+    valid_actions = _compute_valid_actions(*key, num_workers=num_workers)
+    _valid_actions_cache[key] = valid_actions
+    if len(_valid_actions_cache) > _VALID_ACTIONS_CACHE_SIZE:
+        _valid_actions_cache.popitem(last=False)
 
-    # Get valid actions
-    valid_actions = set()
+    return valid_actions
 
-    valid_actions.update(
-        _atom_addition(
-            mol,
-            atom_types=atom_types,
-            atom_valences=atom_valences,
-            atoms_with_free_valence=atoms_with_free_valence
-        )
+
+def _compute_valid_actions(state,
+                           atom_valences,
+                           max_valence,
+                           allow_removal,
+                           allow_no_modification,
+                           allowed_ring_sizes,
+                           allow_bonds_between_rings,
+                           num_workers=None):
+    """Body of get_valid_actions, taking canonical SMILES and tuples"""
+    mol = _smiles_to_mol(state)
+    atom_valences = dict(atom_valences)
+    atom_types = list(atom_valences)
+
+    # Get available atom location
+    impl_hs = [atom.GetNumImplicitHs() for atom in mol.GetAtoms()]
+    atoms_with_free_valence = {
+        i: [idx for idx, num_hs in enumerate(impl_hs) if num_hs >= i]
+        for i in range(1, max_valence)
+    }
+
+    # Enumerate candidate edits, then build and sanitize the edited molecules
+    edits = _atom_addition(
+        mol,
+        atom_types=atom_types,
+        atom_valences=atom_valences,
+        atoms_with_free_valence=atoms_with_free_valence
     )
 
-    valid_actions.update(
+    edits.extend(
         _bond_addition(
             mol,
-            atoms_with_free_valence=atoms_with_free_valence,
+            impl_hs=impl_hs,
+            max_valence=max_valence,
             allowed_ring_sizes=allowed_ring_sizes,
             allow_bonds_between_rings=allow_bonds_between_rings
         )
     )
 
     if allow_removal:
-        valid_actions.update(_bond_removal(mol))
+        edits.extend(_bond_removal(mol))
+
+    # Get valid actions
+    valid_actions = _materialize_edits(state, edits, num_workers)
 
     if allow_no_modification:
-        valid_actions.add(Chem.MolToSmiles(mol))
+        # Keep the state's own canonical SMILES, stereochemistry included, so
+        # this action leaves the state unchanged
+        valid_actions.add(state)
 
-    return valid_actions
+    return frozenset(valid_actions)
 
 
 def _atom_addition(state, atom_types, atom_valences, atoms_with_free_valence):
-    """Compute valid atom addition operation"""
+    """Compute candidate atom addition operation
 
-    bond_orders = {
-        1: Chem.BondType.SINGLE,
-        2: Chem.BondType.DOUBLE,
-        3: Chem.BondType.TRIPLE
-    }
+    Return a list of ('atom_add', atom_idx, element, bond_order) edits.
+    """
 
-    atom_addition = set()
+    atom_addition = []
 
-    for i in bond_orders:
+    # Elements able to take a bond of each order, so the atom loop never filters
+    elements_by_valence = {
+        i: [element for element in atom_types if atom_valences[element] >= i]
+        for i in (1, 2, 3)
+    }
+
+    for i, elements in elements_by_valence.items():
         for atom in atoms_with_free_valence[i]:
-            for element in atom_types:
-                if atom_valences[element] >= i:
-                    new_state = Chem.RWMol(state)
-                    idx = new_state.AddAtom(Chem.Atom(element))
-                    new_state.AddBond(atom, idx, bond_orders[i])
-                    sanitization_result = Chem.SanitizeMol(new_state, catchErrors=True)
-                    if sanitization_result:
-                        continue
-                    atom_addition.add(Chem.MolToSmiles(new_state))
+            for element in elements:
+                atom_addition.append(('atom_add', atom, element, i))
 
     return atom_addition
 
 
-def _bond_addition(state, atoms_with_free_valence, allowed_ring_sizes, allow_bonds_between_rings):
-    """Compute valid bond addition operation"""
+def _enumerate_pairs(impl_hs, max_valence):
+    """Enumerate the atom pairs that can take a new bond of each valence
 
-    bond_orders = [
-        None,
-        Chem.BondType.SINGLE,
-        Chem.BondType.DOUBLE,
-        Chem.BondType.TRIPLE
-    ]
+    Argument
+    ------------
 
-    bond_addition = set()
+        - impl_hs. List of integer.
+            Number of implicit hydrogens of each atom.
 
-    for valence, atoms in atoms_with_free_valence.items():
+        - max_valence. Integer.
+            Valences below this value are considered.
 
-        for atom1, atom2 in itertools.combinations(atoms, 2):
+    Return
 
-            bond = Chem.Mol(state).GetBondBetweenAtoms(atom1, atom2)
-            new_state = Chem.RWMol(state)
-            Chem.Kekulize(new_state, clearAromaticFlags=True)
+        Three parallel int32 arrays (atom1, atom2, valence) with atom1 < atom2
+        and both atoms having at least valence implicit hydrogens.
 
-            if bond is not None:
+    """
+    impl_hs = np.asarray(impl_hs, dtype=np.int32)
+    atom1s, atom2s, valences = [], [], []
 
-                if bond.GetBondType() not in bond_orders:
-                    continue # skip aromatic bond
+    for valence in range(1, max_valence):
+        atoms = np.flatnonzero(impl_hs >= valence).astype(np.int32)
+        i, j = np.triu_indices(len(atoms), k=1)
+        atom1s.append(atoms[i])
+        atom2s.append(atoms[j])
+        valences.append(np.full(len(i), valence, dtype=np.int32))
 
-                # idx = bond.GetIdx()
-                bond_order = bond_orders.index(bond.GetBondType())
-                bond_order += valence
+    if not valences:
+        return tuple(np.zeros(0, dtype=np.int32) for _ in range(3))
 
-                if bond_order < len(bond_orders):
-                    idx = bond.GetIdx()
-                    bond.SetBondType(bond_orders[bond_order])
-                    new_state.ReplaceBond(idx, bond)
-                else:
-                    continue
+    return np.concatenate(atom1s), np.concatenate(atom2s), np.concatenate(valences)
 
-            elif (not allow_bonds_between_rings and
-                  (state.GetAtomWithIdx(atom1).IsInRing() and state.GetAtomWithIdx(atom2).IsInRing())):
-                continue
 
-            elif (allowed_ring_sizes is not None and
-                  len(Chem.rdmolops.GetShortestPath(state, atom1, atom2)) not in allowed_ring_sizes):
-                continue
+def _bond_addition(state, impl_hs, max_valence, allowed_ring_sizes, allow_bonds_between_rings):
+    """Compute candidate bond addition operation
+
+    Return a list of ('bond_set', bond_idx, bond_order) edits for existing
+    bonds and ('bond_add', atom1, atom2, bond_order) edits for new bonds.
+    """
 
-            else:
-                new_state.AddBond(atom1, atom2, bond_orders[valence])
+    atom1, atom2, valence = _enumerate_pairs(impl_hs, max_valence)
+
+    num_atoms = state.GetNumAtoms()
+
+    # Order of the bond between each atom pair: 0 if unbonded, -1 if aromatic
+    bond_order_matrix = np.zeros((num_atoms, num_atoms), dtype=np.int8)
+    bond_index_matrix = np.full((num_atoms, num_atoms), -1, dtype=np.int32)
+    for bond in state.GetBonds():
+        begin, end = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+        bond_order_matrix[begin, end] = bond_order_matrix[end, begin] = (
+            _BOND_ORDER_INDEX.get(bond.GetBondType(), -1))
+        bond_index_matrix[begin, end] = bond_index_matrix[end, begin] = bond.GetIdx()
+
+    current_order = bond_order_matrix[atom1, atom2]
+    new_order = current_order + valence
+
+    # Existing non-aromatic bonds can be raised up to a triple bond
+    set_mask = (current_order > 0) & (new_order <= len(_BOND_ORDER_INDEX))
+
+    add_mask = current_order == 0
+    if not allow_bonds_between_rings:
+        in_ring = np.array([atom.IsInRing() for atom in state.GetAtoms()], dtype=bool)
+        add_mask &= ~(in_ring[atom1] & in_ring[atom2])
+    if allowed_ring_sizes is not None:
+        # The new ring holds every atom on the shortest path between the pair
+        ring_size = Chem.GetDistanceMatrix(state)[atom1, atom2] + 1
+        add_mask &= np.isin(ring_size, list(allowed_ring_sizes))
+
+    bond_addition = [
+        ('bond_set', bond_idx, bond_order)
+        for bond_idx, bond_order in zip(
+            bond_index_matrix[atom1[set_mask], atom2[set_mask]].tolist(),
+            new_order[set_mask].tolist())
+    ]
 
-            sanitization_result = Chem.SanitizeMol(new_state, catchErrors=True)
-            if sanitization_result:
-                continue
-            bond_addition.add(Chem.MolToSmiles(new_state))
+    bond_addition.extend(
+        ('bond_add', begin, end, bond_order)
+        for begin, end, bond_order in zip(
+            atom1[add_mask].tolist(), atom2[add_mask].tolist(), valence[add_mask].tolist())
+    )
 
     return bond_addition
 
 
 def _bond_removal(state):
-    """Compute the valid bond removal """
+    """Compute candidate bond removal
+
+    Return a list of ('bond_set', bond_idx, bond_order) edits for bonds whose
+    order is lowered and ('bond_remove', atom1, atom2) edits.
+    """
+
+    bond_removal = []
+
+    for bond in state.GetBonds():
+
+        current_order = _BOND_ORDER_INDEX.get(bond.GetBondType())
+        if current_order is None:
+            continue
+
+        atom1 = bond.GetBeginAtomIdx()
+        atom2 = bond.GetEndAtomIdx()
+
+        for valence in [1, 2, 3]:
+
+            bond_order = current_order - valence
+
+            if bond_order > 0:
+                bond_removal.append(('bond_set', bond.GetIdx(), bond_order))
+
+            elif bond_order == 0:
+                bond_removal.append(('bond_remove', atom1, atom2))
+
+    return bond_removal
+
+
+def _apply_edits(state, edits):
+    """Build, sanitize and canonicalize the molecules produced by edits
+
+    Argument
+    ------------
+
+        - state. String SMILES.
+            The molecule the edits refer to. It is parsed again here so the
+            function can run in a worker process.
+
+        - edits. List of edit tuples from _atom_addition, _bond_addition or
+            _bond_removal.
+
+    Return
+
+        A set of SMILES of the valid edited molecules. Stereochemistry is not
+        written to the SMILES.
+
+    """
 
     bond_orders = [
         None,
@@ -201,49 +388,93 @@ def _bond_removal(state):
         Chem.BondType.TRIPLE
     ]
 
-    bond_removal = set()
+    mol = _smiles_to_mol(state)
+    # Kekulize once; bond edits are cloned from this base, which is the
+    # molecule itself when there is nothing aromatic to kekulize
+    if any(bond.GetIsAromatic() for bond in mol.GetBonds()):
+        kekulized = Chem.RWMol(mol)
+        Chem.Kekulize(kekulized, clearAromaticFlags=True)
+    else:
+        kekulized = mol
 
-    for valence in [1, 2, 3]:
+    new_states = []
+    removal_states = []
 
-        for bond in state.GetBonds():
+    for edit in edits:
 
-            bond = Chem.Mol(state).GetBondBetweenAtoms(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx())
+        if edit[0] == 'atom_add':
+            _, atom, element, bond_order = edit
+            new_state = Chem.RWMol(mol)
+            idx = new_state.AddAtom(Chem.Atom(element))
+            new_state.AddBond(atom, idx, bond_orders[bond_order])
 
-            if bond.GetBondType() not in bond_orders:
-                continue
+        elif edit[0] == 'bond_add':
+            _, atom1, atom2, bond_order = edit
+            new_state = Chem.RWMol(kekulized)
+            new_state.AddBond(atom1, atom2, bond_orders[bond_order])
 
-            new_state = Chem.RWMol(state)
-            Chem.Kekulize(new_state, clearAromaticFlags=True)
-            bond_order = bond_orders.index(bond.GetBondType())
-            bond_order -= valence
+        elif edit[0] == 'bond_set':
+            _, bond_idx, bond_order = edit
+            new_state = Chem.RWMol(kekulized)
+            new_state.GetBondWithIdx(bond_idx).SetBondType(bond_orders[bond_order])
 
-            if bond_order > 0:
+        else:
+            _, atom1, atom2 = edit
+            new_state = Chem.RWMol(kekulized)
+            new_state.RemoveBond(atom1, atom2)
 
-                idx = bond.GetIdx()
-                bond.SetBondType(bond_orders[bond_order])
-                new_state.ReplaceBond(idx, bond)
+        sanitization_result = Chem.SanitizeMol(new_state, sanitizeOps=_SANITIZE_OPS, catchErrors=True)
+        if sanitization_result:
+            continue
 
-                sanitization_result = Chem.SanitizeMol(new_state, catchErrors=True)
-                if sanitization_result:
-                    continue
+        if edit[0] == 'bond_remove':
+            removal_states.append(new_state)
+        else:
+            new_states.append(new_state)
 
-                bond_removal.add(Chem.MolToSmiles(new_state))
+    results = {Chem.MolToSmiles(m, canonical=True, isomericSmiles=False) for m in new_states}
 
-            elif bond_order == 0:
-                atom1 = bond.GetBeginAtom().GetIdx()
-                atom2 = bond.GetEndAtom().GetIdx()
-                new_state.RemoveBond(atom1, atom2)
-                sanitization_result = Chem.SanitizeMol(new_state, catchErrors=True)
-                if sanitization_result:
-                    continue
+    for smiles in [Chem.MolToSmiles(m, canonical=True, isomericSmiles=False) for m in removal_states]:
+        # Keep the molecule only if at most a single atom was split off
+        parts = sorted(smiles.split('.'), key=len)
+        if len(parts) == 1 or len(parts[0]) == 1:
+            results.add(parts[-1])
 
-                smiles = Chem.MolToSmiles(new_state)
-                parts = sorted(smiles.split('.'), key=len)
+    return results
 
-                if len(parts) == 1 or len(parts[0]) == 1:
-                    bond_removal.add(parts[-1])
 
-    return bond_removal
+def _materialize_edits(state, edits, num_workers):
+    """Run _apply_edits serially or spread across a shared process pool"""
+
+    if not num_workers or num_workers < 2 or len(edits) < num_workers:
+        return _apply_edits(state, edits)
+
+    if num_workers not in _executors:
+        _executors[num_workers] = futures.ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=_MP_CONTEXT)
+    executor = _executors[num_workers]
+
+    chunk_size = -(-len(edits) // num_workers)
+    chunks = [edits[i:i + chunk_size] for i in range(0, len(edits), chunk_size)]
+
+    results = set()
+    try:
+        for chunk_results in executor.map(_apply_edits, [state] * len(chunks), chunks):
+            results.update(chunk_results)
+    except futures.process.BrokenProcessPool:
+        # A crashed worker breaks the pool for good; let the next call start a new one
+        _executors.pop(num_workers, None)
+        executor.shutdown(wait=False)
+        raise
+
+    return results
+
+
+@atexit.register
+def _shutdown_executors():
+    """Stop the worker processes of every shared pool"""
+    while _executors:
+        _executors.popitem()[1].shutdown(wait=True)
 
 
 class Molecule(object):
@@ -258,7 +489,8 @@ class Molecule(object):
                  allowed_ring_sizes=None,
                  max_steps=10,
                  target_fn=None,
-                 record_path=False):
+                 record_path=False,
+                 num_workers=None):
         """Initialization of Molecule Generation MDP
 
         Argument
@@ -292,6 +524,11 @@ class Molecule(object):
             - record_path. Boolean.
                 Whether to record the steps internally.
 
+            - num_workers. Integer or None.
+                Number of processes used to sanitize candidate actions, e.g.
+                os.cpu_count(). The process pool is shared by all instances.
+                If None, candidates are sanitized serially.
+
         """
 
         if isinstance(init_mol, Chem.Mol):
@@ -305,14 +542,17 @@ class Molecule(object):
         self.allowed_ring_sizes = allowed_ring_sizes
         self.max_steps = max_steps
         self._state = None
-        self._valid_actions = []
+        self._state_mol = None
+        self._valid_actions = frozenset()
         self._counter = self.max_steps
         self._target_fn = target_fn
         self.record_path = record_path
+        self.num_workers = num_workers
         self._path = []
         self._max_bonds = 4
         atom_types = list(self.atom_types)
-        self._max_new_bonds = dict(list(zip(atom_types, mol_utils.atom_valences(atom_types))))
+        self._atom_valences = dict(list(zip(atom_types, mol_utils.atom_valences(atom_types))))
+        self._max_valence = max(self._atom_valences.values())
 
     @property
     def state(self):
@@ -328,6 +568,7 @@ class Molecule(object):
     def initialize(self):
         """Reset the MDP to its initial state"""
         self._state = self.init_mol
+        self._state_mol = _smiles_to_mol(self._state) if self._state else None
         if self.record_path:
             self._path = [self._state]
         self._valid_actions = self.get_valid_actions(force_rebuild=True)
@@ -335,12 +576,16 @@ class Molecule(object):
 
     def get_valid_actions(self, state=None, force_rebuild=False):
 
+        mol = None
+
         if state is None:
             if self._valid_actions and not force_rebuild:
-                return copy.deepcopy(self._valid_actions)
+                return self._valid_actions
             state = self._state
+            mol = self._state_mol
 
         if isinstance(state, Chem.Mol):
+            mol = state
             state = Chem.MolToSmiles(state)
 
         self._valid_actions = get_valid_actions(
@@ -349,10 +594,14 @@ class Molecule(object):
             allow_removal=self.allow_removal,
             allow_no_modification=self.allow_no_modification,
             allowed_ring_sizes=self.allowed_ring_sizes,
-            allow_bonds_between_rings=self.allow_bonds_between_rings
+            allow_bonds_between_rings=self.allow_bonds_between_rings,
+            atom_valences=self._atom_valences,
+            max_valence=self._max_valence,
+            num_workers=self.num_workers,
+            mol=mol
         )
 
-        return copy.deepcopy(self._valid_actions)
+        return self._valid_actions
 
     def _reward(self):
         """Get the reward of the state"""
@@ -386,6 +635,9 @@ class Molecule(object):
             raise ValueError('Invalid action.')
 
         self._state = action
+        # Parsed once here; get_valid_actions and _reward reuse this Mol, and
+        # _smiles_to_mol returns it again for the canonical cache key
+        self._state_mol = _smiles_to_mol(action)
         if self.record_path:
             self._path.append(self._state)
 
@@ -419,5 +671,5 @@ class Molecule(object):
         if state is None:
             state = self._state
         if isinstance(state, str):
-            state = Chem.MolFromSmiles(state)
+            state = _smiles_to_mol(state)
         return Draw.MolToImage(state, **kwargs)
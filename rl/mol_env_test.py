@@ -0,0 +1,110 @@
+"""Tests for the molecule MDP environment."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import unittest
+
+from rdkit import Chem
+
+from rl import mol_env
+
+
+class SanitizeOpsTest(unittest.TestCase):
+    """The reduced sanitization must accept and reject the same candidates."""
+
+    SEEDS = [
+        'c1ccccc1O',                   # aromatic
+        'c1ccc2[nH]ccc2c1',            # heteroaromatic, [nH]
+        'c1ccncc1C=O',                 # heteroaromatic
+        'c1ccsc1',                     # aromatic sulfur
+        'O=[N+]([O-])c1ccccc1',        # charged
+        'C[N+](C)(C)CC(=O)[O-]',       # charged, zwitterion
+        'CS(=O)(=O)c1ccccc1',          # sulfone
+        'CC1=CC(=O)C=CC1=O',           # conjugated ring
+    ]
+
+    def setUp(self):
+        self._sanitize_ops = mol_env._SANITIZE_OPS
+        mol_env._valid_actions_cache.clear()
+
+    def tearDown(self):
+        mol_env._SANITIZE_OPS = self._sanitize_ops
+        mol_env._valid_actions_cache.clear()
+
+    def _get_valid_actions(self, state, sanitize_ops, allowed_ring_sizes, allow_bonds_between_rings):
+        mol_env._SANITIZE_OPS = sanitize_ops
+        mol_env._valid_actions_cache.clear()
+        return mol_env.get_valid_actions(
+            state,
+            atom_types={'C', 'N', 'O', 'S'},
+            allow_removal=True,
+            allow_no_modification=True,
+            allowed_ring_sizes=allowed_ring_sizes,
+            allow_bonds_between_rings=allow_bonds_between_rings
+        )
+
+    def test_same_actions_as_full_sanitization(self):
+        configs = itertools.product([None, {5, 6}], [True, False])
+        for allowed_ring_sizes, allow_bonds_between_rings in configs:
+            for seed in self.SEEDS:
+                expected = self._get_valid_actions(
+                    seed, Chem.SanitizeFlags.SANITIZE_ALL, allowed_ring_sizes, allow_bonds_between_rings)
+                actual = self._get_valid_actions(
+                    seed, self._sanitize_ops, allowed_ring_sizes, allow_bonds_between_rings)
+                self.assertEqual(expected, actual, msg='%s %s %s' % (
+                    seed, allowed_ring_sizes, allow_bonds_between_rings))
+
+
+class ParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        mol_env._valid_actions_cache.clear()
+
+    def tearDown(self):
+        mol_env._valid_actions_cache.clear()
+        mol_env._shutdown_executors()
+
+    def _get_valid_actions(self, num_workers):
+        mol_env._valid_actions_cache.clear()
+        return mol_env.get_valid_actions(
+            'c1ccc2[nH]ccc2c1',
+            atom_types={'C', 'N', 'O'},
+            allow_removal=True,
+            allow_no_modification=True,
+            allowed_ring_sizes={5, 6},
+            allow_bonds_between_rings=False,
+            num_workers=num_workers
+        )
+
+    def test_process_pool_matches_serial(self):
+        serial = self._get_valid_actions(None)
+        parallel = self._get_valid_actions(2)
+        self.assertIn(2, mol_env._executors)
+        self.assertEqual(serial, parallel)
+
+
+class ResultTest(unittest.TestCase):
+
+    def test_equal_and_read_only(self):
+        result = mol_env.Result(state='CC', reward=1.0, terminated=False)
+        self.assertEqual(mol_env.Result(state='CC', reward=1.0, terminated=False), result)
+        self.assertNotEqual(mol_env.Result(state='CC', reward=1.0, terminated=True), result)
+        with self.assertRaises(AttributeError):
+            result.state = 'CCC'
+
+
+class MoleculeTest(unittest.TestCase):
+
+    def test_no_modification_keeps_stereo_state(self):
+        env = mol_env.Molecule(atom_types={'C', 'N', 'O'}, init_mol='C[C@H](N)C(=O)O')
+        env.initialize()
+        self.assertIn(env.state, env.get_valid_actions())
+        result = env.step(env.state)
+        self.assertEqual('C[C@H](N)C(=O)O', result.state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,7 +22,7 @@ class TargetWeightMolecule(mol_env.Molecule):
         self.target_weight = target_weight
 
     def _reward(self):
-        molecule = Chem.MolFromSmiles(self._state)
+        molecule = self._state_mol
         if molecule is None:
             return -self.target_weight**2
         lower, upper = self.target_weight - 25, self.target_weight + 25
@@ -54,7 +54,7 @@ class OptQEDMolecule(mol_env.Molecule):
         Returns:
             Float. QED of the current state.
         """
-        molecule = Chem.MolFromSmiles(self._state)
+        molecule = self._state_mol
         if molecule is None:
             return 0.0
         qed = QED.qed(molecule)
@@ -64,7 +64,7 @@ class OptQEDMolecule(mol_env.Molecule):
 class OptLogPMolecule(mol_env.Molecule):
 
     def _reward(self):
-        molecule = Chem.MolFromSmiles(self._state)
+        molecule = self._state_mol
         if molecule is None:
             return 0.0
         return mol_utils.penalized_logp(molecule)
@@ -96,7 +96,7 @@ class TargetSASMolecule(mol_env.Molecule):
             raise ValueError('loss_type must by "l1" or "l2"')
 
     def _reward(self):
-        molecule = Chem.MolFromSmiles(self._state)
+        molecule = self._state_mol
         if molecule is None:
             return -self.loss_fn(self.target_sas)
         sas = sascorer.calculateScore(molecule)
@@ -144,7 +144,16 @@ class TargetSimilarityQED(mol_env.Molecule):
         structure = Chem.MolFromSmiles(smiles)
         if structure is None:
             return 0.0
-        fingerprint_structure = self.get_fingerprint(structure)
+        return self.get_similarity_mol(structure)
+
+    def get_similarity_mol(self, molecule):
+        """Gets the similarity between a parsed molecule and the target molecule.
+        Args:
+        molecule: Chem.Mol. The current molecule.
+        Returns:
+        Float. The Tanimoto similarity.
+        """
+        fingerprint_structure = self.get_fingerprint(molecule)
 
         return DataStructs.TanimotoSimilarity(self._target_mol_fingerprint, fingerprint_structure)
 
@@ -159,10 +168,10 @@ class TargetSimilarityQED(mol_env.Molecule):
         # similarity is zero.
         if self._state is None:
             return 0.0
-        mol = Chem.MolFromSmiles(self._state)
+        mol = self._state_mol
         if mol is None:
             return 0.0
-        similarity_score = self.get_similarity(self._state)
+        similarity_score = self.get_similarity_mol(mol)
         # calculate QED
         qed_value = QED.qed(mol)
         reward = (
@@ -197,7 +206,10 @@ class MultiObjectiveRewardMolecule(mol_env.Molecule):
         structure = Chem.MolFromSmiles(smiles)
         if structure is None:
             return 0.0
-        fingerprint_structure = self.get_fingerprint(structure)
+        return self.get_similarity_mol(structure)
+
+    def get_similarity_mol(self, molecule):
+        fingerprint_structure = self.get_fingerprint(molecule)
 
         return DataStructs.TanimotoSimilarity(self._target_mol_fingerprint, fingerprint_structure)
 
@@ -208,13 +220,13 @@ class MultiObjectiveRewardMolecule(mol_env.Molecule):
         if self._state is None:
             return 0.0, 0.0
 
-        mol = Chem.MolFromSmiles(self._state)
+        mol = self._state_mol
 
         if mol is None:
             return 0.0, 0.0
 
         if mol_utils.contains_scaffold(mol, self._target_mol_scaffold):
-            similarity_score = self.get_similarity(self._state)
+            similarity_score = self.get_similarity_mol(mol)
         else:
             similarity_score = 0.0
 